@@ -105,6 +105,27 @@ def send_couchdb(server, db, user, passwd, doc, wake_up=False):
         pass
 
 
+def send_couchdb_bulk(server, db, user, passwd, docs, wake_up=False):
+    ''' Send several JSON documents to couchdb in a single _bulk_docs request
+    '''
+    try:
+        if wake_up:
+            _wake(server)
+        couch = couchdb.Server(server)
+        couch.resource.credentials = (user, passwd)
+        db = couch[db]
+        results = db.update([json.loads(doc) for doc in docs])
+    except:
+        warnings.warn("Could not connect to {server} to report test results".format(server=server))
+        return
+
+    # _bulk_docs does not fail as a whole when single documents are rejected
+    for success, docid, rev_or_exc in results:
+        if not success:
+            warnings.warn("Could not save test results document {docid} to {server}: {err}".format(
+                          docid=docid, server=server, err=rev_or_exc))
+
+
 ### Software management
 
 def _download_to_dir(url, dirname):
@@ -1,14 +1,24 @@
+from __future__ import print_function
+
 import os
 import stat
-import csv
+import mmap
 import json
 import glob
 import shutil
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
 import sys
+import time
 import subprocess
 import unittest
 import datetime
-from collections import defaultdict
+import threading
+import tempfile
+import itertools
+from multiprocessing.pool import ThreadPool
 
 import facs
 from facs.utils import helpers, galaxy, config
@@ -20,21 +30,59 @@ try:
 except ImportError:
     profile = False
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_HERE = os.path.dirname(__file__)
+DATA_DIR = os.path.join(_HERE, "data")
+PROGS_DIR = os.path.join(DATA_DIR, "bin")
+REFERENCE_DIR = os.path.join(DATA_DIR, "reference")
+BLOOM_DIR = os.path.join(DATA_DIR, "bloom")
+CUSTOM_DIR = os.path.join(DATA_DIR, "custom")
+SYNTHETIC_FASTQ_DIR = os.path.join(DATA_DIR, "synthetic_fastq")
+TMP_DIR = os.path.join(DATA_DIR, "tmp")
+
+# fastq_screen.conf templates and the config keyword of each aligner
+_CONF_HEAD = "\n    %s\t\t%s\n    THREADS\t\t%s\n\n    "
+_CONF_DB = "\n    DATABASE\t%s\t%s\t%s\n    "
+_CONF_ALIGNER = {"bowtie": "BOWTIE", "bowtie2": "BOWTIE2"}
+
+# Version strings of the bowtie binaries, keyed by their paths and mtimes
+_bowtie_versions_cache = {}
+
+def _bowtie_versions_cached(bowtie_path, bowtie_mtime, bowtie2_path, bowtie2_mtime):
+    key = (bowtie_path, bowtie_mtime, bowtie2_path, bowtie2_mtime)
+    if key not in _bowtie_versions_cache:
+        _bowtie_versions_cache[key] = (subprocess.check_output([bowtie_path, "--version"]),
+                                       subprocess.check_output([bowtie2_path, "--version"]))
+    return _bowtie_versions_cache[key]
+
 class FastqScreenTest(unittest.TestCase):
     """Tests against Fastq Screen, to compare performance metrics.
     """
     def setUp(self):
-        self.data_dir  = os.path.join(os.path.dirname(__file__), "data")
-        self.progs = os.path.join(os.path.dirname(__file__), "data", "bin")
-        self.reference = os.path.join(os.path.dirname(__file__), "data", "reference")
-        self.bloom_dir = os.path.join(os.path.dirname(__file__), "data", "bloom")
-        self.custom_dir = os.path.join(os.path.dirname(__file__), "data", "custom")
-        self.synthetic_fastq = os.path.join(os.path.dirname(__file__), "data", "synthetic_fastq")
-        self.tmp = os.path.join(os.path.dirname(__file__), "data", "tmp")
+        self.data_dir  = DATA_DIR
+        self.progs = PROGS_DIR
+        self.reference = REFERENCE_DIR
+        self.bloom_dir = BLOOM_DIR
+        self.custom_dir = CUSTOM_DIR
+        self.synthetic_fastq = SYNTHETIC_FASTQ_DIR
+        self.tmp = TMP_DIR
 
         self.fscreen_url = 'http://www.bioinformatics.babraham.ac.uk/projects/fastq_screen/fastq_screen_v0.4.2.tar.gz'
 
         helpers._mkdir_p(self.tmp)
+        helpers._mkdir_p(self.synthetic_fastq)
+
+        # Invariant across the fastq x reference matrix, resolve only once
+        self._fastqs = [os.path.join(self.synthetic_fastq, fname)
+                        for fname in sorted(os.listdir(self.synthetic_fastq))
+                        if not fname.startswith(".") and fname.endswith((".fq", ".fastq"))]
+        self._fscreen_dst = os.path.join(self.progs, "fastq_screen")
+        self._perl5 = os.path.join(os.environ['HOME'], "perl5")
+        self._perl5lib = os.path.join(self._perl5, "lib", "perl5")
 
         # Check if 2bit decompressor is available
         twobit_fa_path = os.path.join(self.progs, "twoBitToFa")
@@ -43,7 +91,12 @@ class FastqScreenTest(unittest.TestCase):
 
         # Fastq_screen does not use OpenMP, but here we reuse the environment
         # variable from the benchmarks
-        self.fastq_threads = os.environ.get('OMP_NUM_THREADS', 1)
+        self.fastq_threads = int(os.environ.get('OMP_NUM_THREADS', 1))
+        # Number of fastq_screen runs executed concurrently. Memory profiling
+        # samples the whole process tree, so it is only done with FACS_TEST_JOBS=1
+        self.jobs = int(os.environ.get('FACS_TEST_JOBS', 1))
+        # fastq_screen logs are discarded unless FACS_TEST_VERBOSE is set
+        self.verbose = bool(os.environ.get('FACS_TEST_VERBOSE'))
         self.results = []
 
         # XXX: Given the lack of standard reference genomes and indexes repos,
@@ -54,9 +107,8 @@ class FastqScreenTest(unittest.TestCase):
         """ Report collated results of the tests to a remote CouchDB database.
         """
         try:
-            for res in self.results:
-                if config.SERVER:
-                    helpers.send_couchdb(config.SERVER, config.FASTQ_SCREEN_DB, config.USERNAME, config.PASSWORD, res, wake_up=config.WAKE)
+            if config.SERVER and self.results:
+                helpers.send_couchdb_bulk(config.SERVER, config.FASTQ_SCREEN_DB, config.USERNAME, config.PASSWORD, self.results, wake_up=config.WAKE)
 
             # remove fastq_screen files from old test runs
             self._cleanup_fastq_screen_results()
@@ -81,23 +133,19 @@ class FastqScreenTest(unittest.TestCase):
         self._fetch_bowtie_indices()
 
         fscreen_src = os.path.join(dirname, "fastq_screen")
-        fscreen_dst = os.path.join(self.progs, "fastq_screen")
 
-        if not os.path.exists(fscreen_dst):
-            shutil.copy(fscreen_src, self.progs)
-            shutil.copy(fscreen_src + '.conf', self.progs)
+        if not os.path.exists(self._fscreen_dst):
+            shutil.copy(fscreen_src, self._fscreen_dst)
+            shutil.copy(fscreen_src + '.conf', self._fscreen_dst + '.conf')
 
-        # Install VirtualEnv Perl equivalent: cpanm
-        try:
-            subprocess.check_call(['which', 'cpanm'])
-        except:
+        # Install VirtualEnv Perl equivalent: cpanm, unless a previous run already did
+        if not which('cpanm') and not os.path.isdir(self._perl5lib):
             # Try to install fastq_screen dependencies locally, not needed in Travis
             try:
                 subprocess.check_call(['wget', 'cpanmin.us', '-O', 'cpanm'])
-                os.chmod('cpanm', 0700)
+                os.chmod('cpanm', 0o700)
 
-                perl5_local = os.path.join(os.environ['HOME'], '/perl5', 'lib', 'perl5')
-                subprocess.check_call(['./cpanm', '-f', '--local-lib=', perl5_local, 'local::lib'])
+                subprocess.check_call(['./cpanm', '-f', '--local-lib=' + self._perl5, 'local::lib'])
             except:
                 pass
 
@@ -106,40 +154,10 @@ class FastqScreenTest(unittest.TestCase):
         """ Runs fastq_screen tests against synthetically generated fastq files folder.
             It runs generates single threaded config files, to measure performance per-sample.
         """
-        fscreen_dst = os.path.join(self.progs, "fastq_screen")
-        references = glob.glob(os.path.join(self.reference, '*'))
-
-        for fastq in glob.glob(os.path.join(self.synthetic_fastq, "*.f*q")):
-            for ref in references:
-                with open(os.path.join(self.progs, "fastq_screen.conf"), 'w') as cfg:
-                    cfg.write(self._genconf(fastq, ref, self.fastq_threads))
-
-                start_time = str(datetime.datetime.utcnow())+'Z'
-
-                fastq_path = os.path.join(self.synthetic_fastq, fastq)
-                cl = ['perl', '-I', os.path.join(os.environ['HOME'], "perl5/lib/perl5"), '-Mlocal::lib', fscreen_dst,
-                      "--aligner", "bowtie", "--outdir", self.tmp, "--conf", cfg.name, fastq_path]
-                mem = [-1]
-                if profile:
-                    mem = memory_usage((subprocess.call,([cl]),), include_children=True)
-                else:
-                    subprocess.call(cl)
-
-                end_time = str(datetime.datetime.utcnow())+'Z'
+        references = [os.path.join(self.reference, ref) for ref in self._reference_names()]
+        bowtie1_ver, _ = self._bowtie_versions()
 
-                # Process fastq_screen results format and report it in JSON
-                fastq_name = os.path.basename(fastq)
-                fscreen_name = os.path.splitext(fastq_name)[0]+"_screen.txt"
-                fastq_screen_resfile = os.path.join(self.tmp, fscreen_name)
-                if os.path.exists(fastq_screen_resfile):
-                    with open(fastq_screen_resfile, 'rU') as fh:
-                        bowtie1_ver, _ = self._bowtie_versions()
-                        self.results.append(self._fastq_screen_metrics_to_json(fh, \
-                                fastq_name, ref, start_time, end_time, mem, bowtie1_ver))
-                    # Clean to avoid parsing the wrong results file
-                    os.remove(fastq_screen_resfile)
-
-                self._cleanup_fastq_screen_results()
+        self._run_fastq_screen_matrix(references, "bowtie", bowtie1_ver)
 
     def test_3_run_fastq_screen_with_bowtie2(self):
         """ Runs fastq_screen using bowtie2 tests against synthetically generated fastq files folder.
@@ -153,112 +171,185 @@ class FastqScreenTest(unittest.TestCase):
         if not os.path.exists(self.site_prefix):
             pass
 
-        fscreen_dst = os.path.join(self.progs, "fastq_screen")
         bowtie2_paths = self._find_bowtie2_indices()
+        _, bowtie2_ver = self._bowtie_versions()
 
-        for fastq in glob.glob(os.path.join(self.synthetic_fastq, "*.f*q")):
-            for ref in bowtie2_paths:
-                with open(os.path.join(self.progs, "fastq_screen.conf"), 'w') as cfg:
-                    cfg.write(self._genconf(fastq, ref, self.fastq_threads, "bowtie2"))
-
-                start_time = str(datetime.datetime.utcnow())+'Z'
+        self._run_fastq_screen_matrix(bowtie2_paths, "bowtie2", bowtie2_ver)
 
-                fastq_path = os.path.join(self.synthetic_fastq, fastq)
-                cl = ['perl', '-I', os.path.join(os.environ['HOME'], "perl5/lib/perl5"), '-Mlocal::lib', fscreen_dst,
-                      "--aligner", "bowtie2", "--outdir", self.tmp, "--conf", cfg.name, fastq_path]
-
-                mem = [-1]
-                if profile:
-                    mem = memory_usage((subprocess.call,([cl]),), include_children=True)
-                else:
-                    subprocess.call(cl)
+    def _run_fastq_screen_matrix(self, references, aligner, prov):
+        """ Screens every synthetic fastq against every reference, running up to
+            self.jobs fastq_screen instances at once.
+        """
+        pairs = list(itertools.product(self._fastqs, references))
+        run = lambda pair: self._run_fastq_screen(pair[0], pair[1], aligner, prov)
 
-                end_time = str(datetime.datetime.utcnow())+'Z'
+        if self.jobs > 1:
+            # Threads are enough, the actual work happens in fastq_screen subprocesses
+            pool = ThreadPool(self.jobs)
+            try:
+                results = pool.map(run, pairs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(run, pairs)
 
-                # Process fastq_screen results format and report it in JSON
-                fastq_name = os.path.basename(fastq)
-                fscreen_name = os.path.splitext(fastq_name)[0]+"_screen.txt"
-                fastq_screen_resfile = os.path.join(self.tmp, fscreen_name)
-                if os.path.exists(fastq_screen_resfile):
-                    with open(fastq_screen_resfile, 'rU') as fh:
-                        _, bowtie2_ver = self._bowtie_versions()
-                        self.results.append(self._fastq_screen_metrics_to_json(fh, fastq_name, ref, start_time, end_time, mem, bowtie2_ver))
-                    # Clean to avoid parsing the wrong results file
-                    os.remove(fastq_screen_resfile)
+        self.results.extend(res for res in results if res)
 
-                self._cleanup_fastq_screen_results()
+    def _run_fastq_screen(self, fastq, ref, aligner, prov):
+        """ Runs fastq_screen on a single fastq against a single reference and
+            returns its metrics in JSON, or None if no results were produced.
+        """
+        # Per-job config file and output directory, so that concurrent runs
+        # do not overwrite each other's files
+        outdir = tempfile.mkdtemp(dir=self.tmp)
+        with tempfile.NamedTemporaryFile('w', suffix='.conf', delete=False, dir=self.tmp) as cfg:
+            cfg.write(self._genconf(fastq, ref, self.fastq_threads, aligner))
 
+        cl = ['perl', '-I', self._perl5lib, '-Mlocal::lib', self._fscreen_dst,
+              "--aligner", aligner, "--outdir", outdir, "--conf", cfg.name, fastq]
 
-    def _fastq_screen_metrics_to_json(self, in_handle, fastq_name, ref, start_time, end_time, mem, prov):
-        reader = csv.reader(in_handle, delimiter="\t")
-        data = defaultdict(lambda: defaultdict(list))
+        try:
+            with open(os.devnull, 'w') as devnull:
+                out = None if self.verbose else devnull
+                call_kw = {'stdout': out, 'stderr': out, 'close_fds': True}
+
+                start_time = time.time()
+
+                # No memory figures without memory_profiler, nor for concurrent
+                # jobs, which would be measured along with their siblings
+                mem = None
+                if profile and self.jobs == 1:
+                    # Only the peak is reported, no need to keep the whole trace.
+                    # Sampling a running process (rather than a callable) never
+                    # re-runs fastq_screen when it finishes within a few samples.
+                    p = subprocess.Popen(cl, **call_kw)
+
+                    # The sampler only notices the exit after its next interval,
+                    # so the end time comes from a thread blocked on the process
+                    exit_times = []
+                    waiter = threading.Thread(target=lambda: (p.wait(), exit_times.append(time.time())))
+                    waiter.start()
+                    try:
+                        mem = memory_usage(proc=p, interval=0.5,
+                                           include_children=True, max_usage=True)
+                    finally:
+                        if p.poll() is None:
+                            p.kill()
+                        waiter.join()
+                    end_time = exit_times[0]
+                else:
+                    subprocess.call(cl, **call_kw)
+                    end_time = time.time()
+        finally:
+            os.unlink(cfg.name)
+
+        # Process fastq_screen results format and report it in JSON
+        res = None
+        fastq_name = os.path.basename(fastq)
+        fscreen_name = os.path.splitext(fastq_name)[0]+"_screen.txt"
+        fastq_screen_resfile = os.path.join(outdir, fscreen_name)
+        if os.path.exists(fastq_screen_resfile):
+            with open(fastq_screen_resfile, 'rb') as fh:
+                # Empty files cannot be mapped, nor is there anything to parse in them
+                if os.fstat(fh.fileno()).st_size:
+                    mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                    try:
+                        res = self._fastq_screen_metrics_to_json(mm[:].decode('utf-8'), fastq_name,
+                                                                 ref, start_time, end_time, mem, prov)
+                    finally:
+                        mm.close()
+
+        self._cleanup_fastq_screen_results(fastq_name, outdir)
+
+        return res
+
+    def _fastq_screen_metrics_to_json(self, text, fastq_name, ref, start_time, end_time, mem, prov):
+        # Screen files are a few lines long, split them in one go
+        lines = text.splitlines()
         ref = os.path.basename(ref)
 
         #Fastq_screen version: 0.4.2
-        version = reader.next()
+        version = lines[0].split("\t")
 
         #['Library', '#Reads_processed', '#Unmapped', '%Unmapped',
         # '#One_hit_one_library', '%One_hit_one_library',
         # '#Multiple_hits_one_library', '%Multiple_hits_one_library',
         # '#One_hit_multiple_libraries', '%One_hit_multiple_libraries',
         # 'Multiple_hits_multiple_libraries', '%Multiple_hits_multiple_libraries']
-        header = reader.next()
-
-        data['sample'] = os.path.join(os.path.dirname(fastq_name), fastq_name)
-        data['begin_timestamp'] = start_time
-        data['end_timestamp'] = end_time
-        data['organisms'] = []
-
-        # Add provenance such as which version of bowtie is running
-        data['fastq_screen_version'] = prov
-
-        for row in reader:
+        header = lines[1].split("\t")
+
+        data = {'sample': os.path.join(os.path.dirname(fastq_name), fastq_name),
+                'begin_timestamp': self._utc_timestamp(start_time),
+                'end_timestamp': self._utc_timestamp(end_time),
+                'organisms': [],
+                # Add provenance such as which version of bowtie is running
+                'fastq_screen_version': prov}
+
+        # Library name first, then numeric columns converted in bulk per row
+        metrics = header[1:]
+        for line in lines[2:]:
             # skip empty rows
-            if not row:
+            if not line:
                 break
+            row = line.split("\t")
+            if len(row) < len(header):
+                raise ValueError("Truncated fastq_screen results row: {0}".format(line))
 
-            organism = {}
+            organism = dict(zip(metrics, map(float, row[1:len(header)])))
             organism[header[0]] = ref
-            # Go through all headers
-            for i in range(1, len(header)):
-                organism[header[i]] = float(row[i])
             data['organisms'].append(organism)
 
-            # Useful to compare with other programs such as FACS or Deconseq
-            print data['organisms']
-            data['contamination_rate'] = data['organisms'][0]['%One_hit_one_library'] + \
-                                         data['organisms'][0]['%Multiple_hits_one_library'] + \
-                                         data['organisms'][0]['%One_hit_multiple_libraries']
+        # Useful to compare with other programs such as FACS or Deconseq
+        if data['organisms']:
+            # Only the first organism is screened per config file
+            first = data['organisms'][0]
+            data['contamination_rate'] = first['%One_hit_one_library'] + \
+                                         first['%Multiple_hits_one_library'] + \
+                                         first['%One_hit_multiple_libraries']
 
             # Percent of mapped/unmapped should be around 100% or less
             # (XXX better way to assert this)
-            assert data['contamination_rate'] + data['organisms'][0]['%Unmapped'] <= 101
+            assert data['contamination_rate'] + first['%Unmapped'] <= 101
 
             # Normalize contamination to [0, 1] values, in order to
             # make it easily comparable with those from FACS
             data['contamination_rate'] = float(data['contamination_rate']) / 100
 
             # reference
-            data['fastq_screen_index'] = data['organisms'][0]['Library']
+            data['fastq_screen_index'] = first['Library']
 
 
         # Which fastq_screen version are we running?
         data['fastq_screen_version'] = version
         # How many threads are bowtie/fastqscreen using in this test?
         data['threads'] = self.fastq_threads
-        data['max_mem'] = max(mem)
-        data['min_mem'] = min(mem)
-        data['mean_mem'] = sum(mem)/float(len(mem))
+        # Peak memory usage (None when not profiled), the sampler does not
+        # keep min/mean figures so they report the peak as well
+        data['max_mem'] = data['min_mem'] = data['mean_mem'] = mem
 
+        if orjson:
+            return orjson.dumps(data).decode('utf-8')
         return json.dumps(data)
 
+    def _utc_timestamp(self, epoch):
+        """ Formats seconds since the epoch as the UTC timestamps reported to CouchDB
+        """
+        return str(datetime.datetime.utcfromtimestamp(epoch))+'Z'
+
+    def _reference_names(self):
+        """ Sorted names of the reference genome directories, skipping hidden
+            (i.e rsync partial) entries
+        """
+        return [ref for ref in sorted(os.listdir(self.reference))
+                if not ref.startswith(".") and os.path.isdir(os.path.join(self.reference, ref))]
+
     def _fetch_bowtie_indices(self):
-        genomes = []
-        for ref in os.listdir(self.reference):
-            # Downloads bowtie indexes genome(s)
-            genomes.append(ref)
-            #XXX: parametrize for bowtie2, although it is possible that bowtie2 indices are
-            # not still properly generated in the Galaxy rsync :_(
+        # Downloads bowtie indexes genome(s), all of them in one go
+        genomes = self._reference_names()
+        #XXX: parametrize for bowtie2, although it is possible that bowtie2 indices are
+        # not still properly generated in the Galaxy rsync :_(
+        if genomes:
             galaxy.rsync_genomes(self.reference, genomes, ["bowtie"])
 
     def _find_bowtie2_indices(self):
@@ -277,7 +368,7 @@ class FastqScreenTest(unittest.TestCase):
                          'phiX': 'phiX174'
                    }
 
-        for ref in os.listdir(self.reference):
+        for ref in self._reference_names():
             test_ref = os.path.basename(ref)
             bowtie2_paths.append(os.path.join(self.site_prefix, site_map[test_ref], test_ref, "bowtie2", test_ref))
 
@@ -288,13 +379,13 @@ class FastqScreenTest(unittest.TestCase):
             running while running the testsuite.
         """
         try:
-            bowtie1_ver = subprocess.check_output(["bowtie", "--version"])
-            bowtie2_ver = subprocess.check_output(["bowtie2", "--version"])
+            bowtie1 = os.path.realpath(which("bowtie"))
+            bowtie2 = os.path.realpath(which("bowtie2"))
+            return _bowtie_versions_cached(bowtie1, os.stat(bowtie1).st_mtime,
+                                           bowtie2, os.stat(bowtie2).st_mtime)
         except:
             raise RuntimeError('bowtie1 or bowtie2 seem to be missing, aborting test')
 
-        return bowtie1_ver, bowtie2_ver
-
     def _genconf(self, query, reference, threads, bowtie="bowtie"):
         # The latter string (reference) shouldn't start with a slash
         if bowtie == 'bowtie2':
@@ -302,23 +393,26 @@ class FastqScreenTest(unittest.TestCase):
         else:
             bwt_index = os.path.join(self.reference, reference, bowtie+"_index", os.path.basename(reference))
 
-        config_dbs = ""
+        aligner = _CONF_ALIGNER[bowtie]
+        return _CONF_HEAD % (aligner, bowtie, threads) + \
+               _CONF_DB % (os.path.basename(reference), bwt_index, aligner)
 
-        self.config = """
-    BOWTIE\t\t{bowtie}
-    THREADS\t\t{threads}\n
-    """.format(bowtie=bowtie, threads=self.fastq_threads)
-
-        config_dbs = """
-    DATABASE\t{short_name}\t{full_path}\t{bowtie}
-    """.format(short_name=os.path.basename(reference),
-           full_path=bwt_index, bowtie=str.upper(bowtie))
-
-        return self.config+config_dbs
-
-    def _cleanup_fastq_screen_results(self):
+    def _cleanup_fastq_screen_results(self, fastq_name=None, outdir=None):
         """ Delete results files across unit tests and teardown
         """
-        # remove fastq_screen files from old test runs (bowtie1 vs bowtie2 have the same results files)
-        shutil.rmtree(self.tmp)
-        os.mkdir(self.tmp)
+        if fastq_name:
+            # Only the _screen.txt and _screen.png files of this fastq are produced
+            outdir = outdir or self.tmp
+            fscreen_name = os.path.splitext(fastq_name)[0]+"_screen"
+            for fname in glob.glob(os.path.join(outdir, fscreen_name+"*")):
+                os.unlink(fname)
+            if outdir != self.tmp:
+                try:
+                    os.rmdir(outdir)
+                except OSError:
+                    # Unexpected leftovers, tearDown wipes them
+                    pass
+        else:
+            # remove fastq_screen files from old test runs (bowtie1 vs bowtie2 have the same results files)
+            shutil.rmtree(self.tmp)
+            os.mkdir(self.tmp)